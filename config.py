@@ -21,3 +21,44 @@ SQLALCHEMY_DATABASE_URI = "postgresql://{}:{}@{}:{}/{}".format(
 print(SQLALCHEMY_DATABASE_URI)
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ENGINE_OPTIONS = {"isolation_level": "READ COMMITTED"}
+
+# Breakdown materialized views
+BREAKDOWN_REFRESH_INTERVAL = config("BREAKDOWN_REFRESH_INTERVAL", default=300, cast=int)
+
+# Cold-storage archival of old events
+ARCHIVE_DIR = config("ARCHIVE_DIR", default=path.join(BASEDIR, "archive"))
+ARCHIVE_AFTER_DAYS = config("ARCHIVE_AFTER_DAYS", default=90, cast=int)
+ARCHIVE_BATCH_SIZE = config("ARCHIVE_BATCH_SIZE", default=50000, cast=int)
+ARCHIVE_INTERVAL = config("ARCHIVE_INTERVAL", default=86400, cast=int)
+
+# Ingest admission control
+INGEST_MAX_CONCURRENT = config("INGEST_MAX_CONCURRENT", default=8, cast=int)
+INGEST_MAX_QUEUE = config("INGEST_MAX_QUEUE", default=64, cast=int)
+INGEST_MAX_QUEUE_PER_TAG = config("INGEST_MAX_QUEUE_PER_TAG", default=16, cast=int)
+INGEST_QUEUE_TIMEOUT = config("INGEST_QUEUE_TIMEOUT", default=5.0, cast=float)
+INGEST_RETRY_AFTER = config("INGEST_RETRY_AFTER", default=1, cast=int)
+
+# Push of statistics to panels
+PUSH_URL_TEMPLATE = config("PUSH_URL_TEMPLATE", default="https://{domain}/api/statistics")
+PUSH_INTERVAL = config("PUSH_INTERVAL", default=60, cast=int)
+PUSH_PERIOD = config("PUSH_PERIOD", default="month")
+PUSH_BATCH_SIZE = config("PUSH_BATCH_SIZE", default=100, cast=int)
+PUSH_WORKERS = config("PUSH_WORKERS", default=4, cast=int)
+# hosts whose keep-alive connections are kept, at least the number of active panels
+PUSH_POOL_HOSTS = config("PUSH_POOL_HOSTS", default=64, cast=int)
+PUSH_TIMEOUT = config("PUSH_TIMEOUT", default=10.0, cast=float)
+PUSH_MAX_RETRIES = config("PUSH_MAX_RETRIES", default=3, cast=int)
+PUSH_BACKOFF = config("PUSH_BACKOFF", default=0.5, cast=float)
+# longer waits, including a longer Retry-After, are left to the next push
+PUSH_MAX_BACKOFF = config("PUSH_MAX_BACKOFF", default=10.0, cast=float)
+
+# Most users one batch statistics request may ask for; each user adds a
+# condition to the same query. Keep PUSH_BATCH_SIZE below it.
+BATCH_STATISTICS_MAX_USERS = config("BATCH_STATISTICS_MAX_USERS", default=500, cast=int)
+
+# Seconds after which an ingest transaction is certainly finished, used to
+# settle statistics cursors; keep it above twice the longest ingest transaction
+CURSOR_SAFETY_WINDOW = config("CURSOR_SAFETY_WINDOW", default=60, cast=int)
+# Most ids a cursor part lists above its watermark; past it the cursor drops
+# the rest and the next delta may repeat events (flagged as may_repeat)
+CURSOR_MAX_SEEN = config("CURSOR_MAX_SEEN", default=200, cast=int)
@@ -0,0 +1,12 @@
+import os
+
+
+# config.py requires the database settings; the tests never connect
+for name, value in {
+    "DB_HOST": "localhost",
+    "DB_NAME": "panel",
+    "DB_USER": "panel",
+    "DB_PASSWORD": "panel",
+    "DB_PORT": "5432",
+}.items():
+    os.environ.setdefault(name, value)
@@ -113,7 +113,9 @@ class FilterData(BaseModel):
     service_tag: str
     app_hash: Optional[str] = None
     campaign_hash: Optional[str] = None
+    request_parameters: Optional[dict] = None
     period: Optional[str] = "month"
+    since: Optional[str] = None
 
     model_config = {
         "json_schema_extra": {
@@ -123,7 +125,37 @@ class FilterData(BaseModel):
                     "service_tag": "service_tag",
                     "app_hash": None,
                     "campaign_hash": None,
+                    "request_parameters": {"sub1": "sub_id"},
                     "period": "month",
+                    "since": None,
+                }
+            ]
+        }
+    }
+
+
+class BreakdownFilterData(BaseModel):
+    user_hash: str
+    service_tag: str
+    source: Optional[str] = "campaign"
+    dimensions: list[str] = ["country"]
+    app_hash: Optional[str] = None
+    campaign_hash: Optional[str] = None
+    event_result: Optional[str] = None
+    period: Optional[str] = "month"
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "user_hash": "user_hash",
+                    "service_tag": "service_tag",
+                    "source": "campaign",
+                    "dimensions": ["country", "device"],
+                    "app_hash": None,
+                    "campaign_hash": "campaign_hash",
+                    "event_result": None,
+                    "period": "week",
                 }
             ]
         }
@@ -1,16 +1,32 @@
+import threading
+
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from fastui import FastUI, AnyComponent, prebuilt_html, components as c
 from fastui.components.display import DisplayMode, DisplayLookup
 from fastui.events import GoToEvent, BackEvent
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from config import SQLALCHEMY_DATABASE_URI
-from dataclass import AppEventData, CampaignEventData, FilterData
-from models import Panel, Statistics
+from config import (
+    SQLALCHEMY_DATABASE_URI,
+    BREAKDOWN_REFRESH_INTERVAL,
+    ARCHIVE_INTERVAL,
+    INGEST_MAX_CONCURRENT,
+    INGEST_MAX_QUEUE,
+    INGEST_MAX_QUEUE_PER_TAG,
+    INGEST_QUEUE_TIMEOUT,
+    INGEST_RETRY_AFTER,
+    PUSH_INTERVAL,
+)
+from dataclass import AppEventData, CampaignEventData, FilterData, BreakdownFilterData
+from models import Panel, PanelPush, Statistics
 from utils import logger
+from utils.admission import AdmissionController, Overloaded
+from utils.archiver import Archiver
 from utils.collector import Collector
+from utils.statistics_updater import StatisticsUpdater
 
 
 engine = create_engine(SQLALCHEMY_DATABASE_URI)
@@ -18,6 +34,57 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 logs = logger.get_logger(__name__)
 app = FastAPI()
+background_jobs_stop = threading.Event()
+ingest_admission = AdmissionController(
+    max_concurrent=INGEST_MAX_CONCURRENT,
+    max_queue=INGEST_MAX_QUEUE,
+    max_queue_per_tag=INGEST_MAX_QUEUE_PER_TAG,
+    queue_timeout=INGEST_QUEUE_TIMEOUT,
+    retry_after=INGEST_RETRY_AFTER,
+)
+statistics_updater = StatisticsUpdater(Collector)
+
+
+def run_periodically(interval: int, job, name: str):
+    while not background_jobs_stop.wait(interval):
+        session = SessionLocal()
+        try:
+            job(session)
+        except Exception as e:
+            logs.error(f"Error running {name}: \n{e}")
+        finally:
+            session.close()
+
+
+@app.on_event("startup")
+def start_background_jobs():
+    jobs = (
+        (
+            BREAKDOWN_REFRESH_INTERVAL,
+            lambda session: Collector(session).refresh_breakdown_views(),
+            "breakdown views refresh",
+        ),
+        (
+            ARCHIVE_INTERVAL,
+            lambda session: Archiver(session).archive_events(),
+            "event archival",
+        ),
+        (
+            PUSH_INTERVAL,
+            statistics_updater.push,
+            "statistics push",
+        ),
+    )
+    for interval, job, name in jobs:
+        threading.Thread(
+            target=run_periodically, args=(interval, job, name), daemon=True
+        ).start()
+
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    background_jobs_stop.set()
+    statistics_updater.close()
 
 
 @app.get("/")
@@ -75,75 +142,175 @@ async def get_panel_statistics(panel_id: int):
             "msg": "Panel not found"
             }, status_code=404)
 
+@app.get("/panels/{panel_id}/push")
+async def get_panel_push(panel_id: int):
+    with SessionLocal() as session:
+        push = session.get(PanelPush, panel_id)
+        if push:
+            return JSONResponse(content={"success": True, "data": push.model_dump()})
+        
+        return JSONResponse(content={
+            "success": False, 
+            "msg": "Nothing pushed to this panel yet"
+            }, status_code=404)
+
+@app.exception_handler(Overloaded)
+async def handle_overloaded(request: Request, e: Overloaded):
+    return JSONResponse(
+        content={
+            "success": False, 
+            "msg": f"Server is overloaded ({e.reason}). Retry later"
+        },
+        status_code=e.status_code,
+        headers={"Retry-After": str(e.retry_after)},
+        )
+
+@app.get("/admission_metrics")
+async def get_admission_metrics():
+    return JSONResponse(content={
+        "success": True, 
+        "data": ingest_admission.model_dump()
+        })
+
 @app.post("/campaign_event")
 async def save_campaign_event(data: CampaignEventData):
     logs.info("Received campaign event.")
+    async with ingest_admission.slot(data.service_tag):
+        session = SessionLocal()
+        try:
+            collector = Collector(session)
+            await run_in_threadpool(collector.save_campaign_event, data)
+            
+            if data.event_result == "app":
+                await run_in_threadpool(collector.save_app_view_from_campaign, data)
+            
+            session.close()
+            statistics_updater.mark_changed(data.service_tag, data.user_hash)
+            logs.info("Campaign event saved.")
+            return JSONResponse(content={
+                "success": True, 
+                "msg": "Campaign event saved"
+                })
+        except Exception as e:
+            session.close()
+            logs.error(f"Error saving campaign event: \n{e}")
+            return JSONResponse(content={
+                "success": False, 
+                "msg": "Error saving campaign event. Check logs for more details"
+                }, status_code=500)
+
+@app.post("/app_event")
+async def save_app_event(data: AppEventData):
+    logs.info("Received app event.")
+    async with ingest_admission.slot(data.service_tag):
+        session = SessionLocal()
+        try:
+            await run_in_threadpool(Collector(session).save_app_event, data)
+            session.close()
+            statistics_updater.mark_changed(data.service_tag, data.user_hash)
+            logs.info("App event saved.")
+            return JSONResponse(
+                content={
+                    "success": True, 
+                    "msg": "App event saved"
+                },
+                status_code=200
+                )
+        except Exception as e:
+            session.close()
+            logs.error(f"Error saving app event: \n{e}")
+            return JSONResponse(
+                content={
+                    "success": False, 
+                    "msg": "Error saving app event. Check logs for more details"
+                },
+                status_code=500
+                )
+
+@app.post("/user_statistics")
+async def generate_user_statistics(data: FilterData):
+    logs.info("Generating user statistics.")
     session = SessionLocal()
     try:
-        collector = Collector(session)
-        collector.save_campaign_event(data)
-        
-        if data.event_result == "app":
-            collector.save_app_view_from_campaign(data)
-        
+        statistics = Collector(session).generate_user_statistics(data)
         session.close()
-        logs.info("Campaign event saved.")
+        logs.info(f"User statistics generated. \n\t{statistics}")
         return JSONResponse(content={
             "success": True, 
-            "msg": "Campaign event saved"
+            "data": statistics
             })
+    except ValueError as e:
+        session.close()
+        return JSONResponse(content={
+            "success": False, 
+            "msg": str(e)
+            }, status_code=400)
     except Exception as e:
         session.close()
-        logs.error(f"Error saving campaign event: \n{e}")
+        logs.error(f"Error generating user statistics: \n{e}")
         return JSONResponse(content={
             "success": False, 
-            "msg": "Error saving campaign event. Check logs for more details"
+            "msg": "Error generating user statistics. Check logs for more details"
             })
 
-@app.post("/app_event")
-async def save_app_event(data: AppEventData):
-    logs.info("Received app event.")
+@app.post("/user_statistics/batch")
+async def generate_batch_user_statistics(data: list[FilterData]):
+    logs.info("Generating batch user statistics.")
     session = SessionLocal()
     try:
-        Collector(session).save_app_event(data)
+        statistics = Collector(session).generate_batch_user_statistics(data)
         session.close()
-        logs.info("App event saved.")
-        return JSONResponse(
-            content={
-                "success": True, 
-                "msg": "App event saved"
-            },
-            status_code=200
-            )
+        logs.info(f"Batch user statistics generated for {len(statistics)} users.")
+        return JSONResponse(content={
+            "success": True, 
+            "data": statistics
+            })
+    except ValueError as e:
+        session.close()
+        return JSONResponse(content={
+            "success": False, 
+            "msg": str(e)
+            }, status_code=400)
     except Exception as e:
         session.close()
-        logs.error(f"Error saving app event: \n{e}")
-        return JSONResponse(
-            content={
-                "success": False, 
-                "msg": "Error saving app event. Check logs for more details"
-            },
-            status_code=500
-            )
+        logs.error(f"Error generating batch user statistics: \n{e}")
+        return JSONResponse(content={
+            "success": False, 
+            "msg": "Error generating batch user statistics. Check logs for more details"
+            }, status_code=500)
 
-@app.post("/user_statistics")
-async def generate_user_statistics(data: FilterData):
-    logs.info("Generating user statistics.")
+@app.post("/breakdown")
+async def generate_breakdown(data: BreakdownFilterData):
+    logs.info("Generating breakdown.")
     session = SessionLocal()
     try:
-        statistics = Collector(session).generate_user_statistics(data)
+        breakdown = Collector(session).generate_breakdown(data)
         session.close()
-        logs.info(f"User statistics generated. \n\t{statistics}")
+        logs.info("Breakdown generated.")
         return JSONResponse(content={
             "success": True, 
-            "data": statistics
+            "data": breakdown
             })
+    except ValueError as e:
+        session.close()
+        return JSONResponse(content={
+            "success": False, 
+            "msg": str(e)
+            }, status_code=400)
     except Exception as e:
         session.close()
-        logs.error(f"Error generating user statistics: \n{e}")
+        logs.error(f"Error generating breakdown: \n{e}")
         return JSONResponse(content={
             "success": False, 
-            "msg": "Error generating user statistics. Check logs for more details"
+            "msg": "Error generating breakdown. Check logs for more details"
+            }, status_code=500)
+
+@app.get("/storage_statistics")
+async def get_storage_statistics():
+    with SessionLocal() as session:
+        return JSONResponse(content={
+            "success": True, 
+            "data": Collector(session).storage_statistics()
             })
 
 @app.get("/ui/campaign_statistics")
@@ -1,26 +1,39 @@
+from contextlib import contextmanager
+
 from sqlalchemy import (
     ARRAY,
     Text,
     Column,
     Integer,
     Float,
-    JSON,
+    Index,
     String,
     DateTime,
     Boolean,
     ForeignKey,
+    MetaData,
+    Table,
+    Date,
+    BigInteger,
     create_engine,
+    text,
+    UniqueConstraint,
 )
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 
 from config import SQLALCHEMY_DATABASE_URI
+from utils import logger
 
 
 engine = create_engine(SQLALCHEMY_DATABASE_URI)
 Base = declarative_base()
 
+logs = logger.get_logger(__name__)
+
 
 class Panel(Base):
     __tablename__ = "panels"
@@ -111,23 +124,106 @@ class PanelUser(Base):
         }
 
 
+class DimensionMixin:
+    """
+    Dictionary-encoded string shared by many event rows. Events reference
+    the integer id instead of repeating the string.
+    """
+    id = Column(Integer, primary_key=True)
+    value = Column(String, unique=True)
+    
+    def __repr__(self):
+        return f"<{type(self).__name__}(value={self.value})>"
+    
+    def __str__(self):
+        return f"{self.value}"
+
+
+class ServiceTag(DimensionMixin, Base):
+    __tablename__ = "service_tags"
+
+
+class Domain(DimensionMixin, Base):
+    __tablename__ = "domains"
+
+
+class Country(DimensionMixin, Base):
+    __tablename__ = "countries"
+
+
+class City(DimensionMixin, Base):
+    __tablename__ = "cities"
+
+
+class Device(DimensionMixin, Base):
+    __tablename__ = "devices"
+
+
+class Campaign(Base):
+    __tablename__ = "campaigns"
+    # NULLS NOT DISTINCT (PostgreSQL 15+) so rows with missing parts are
+    # deduplicated as well
+    __table_args__ = (
+        UniqueConstraint(
+            "campaign_hash", "campaign_name", postgresql_nulls_not_distinct=True
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    campaign_hash = Column(String, index=True)
+    campaign_name = Column(String)
+    
+    def __repr__(self):
+        return f"<Campaign(campaign_name={self.campaign_name}, campaign_hash={self.campaign_hash})>"
+    
+    def __str__(self):
+        return f"{self.campaign_name} - {self.campaign_hash}"
+
+
+class App(Base):
+    __tablename__ = "apps"
+    __table_args__ = (
+        UniqueConstraint(
+            "app_hash", "app_name", "app_tags", postgresql_nulls_not_distinct=True
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    app_hash = Column(String, index=True)
+    app_name = Column(String)
+    app_tags = Column(ARRAY(String))
+    
+    def __repr__(self):
+        return f"<App(app_name={self.app_name}, app_hash={self.app_hash})>"
+    
+    def __str__(self):
+        return f"{self.app_name} - {self.app_hash}"
+
+
 class CampaignEvent(Base):
     __tablename__ = "campaign_events"
+    __table_args__ = (
+        Index(
+            "ix_campaign_events_request_parameters",
+            "request_parameters",
+            postgresql_using="gin",
+            postgresql_ops={"request_parameters": "jsonb_path_ops"},
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     campaign_id = Column(Integer)
-    campaign_name = Column(String)
-    campaign_hash = Column(String, index=True)
+    campaign_key = Column(Integer, ForeignKey("campaigns.id"), index=True)
     subuser_hash = Column(String, index=True)
-    service_tag = Column(String)
+    service_tag_key = Column(Integer, ForeignKey("service_tags.id"))
     
     clid = Column(String)
-    domain = Column(String, index=True)
-    request_parameters = Column(JSON)
+    domain_key = Column(Integer, ForeignKey("domains.id"), index=True)
+    request_parameters = Column(JSONB)
     user_ip = Column(String)
-    country = Column(String, index=True)
-    city = Column(String, index=True)
-    device = Column(String)
+    country_key = Column(Integer, ForeignKey("countries.id"), index=True)
+    city_key = Column(Integer, ForeignKey("cities.id"), index=True)
+    device_key = Column(Integer, ForeignKey("devices.id"))
     
     event_result = Column(String)
     app_id = Column(Integer)
@@ -139,12 +235,57 @@ class CampaignEvent(Base):
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
+    campaign_dim = relationship("Campaign", lazy="joined")
+    service_tag_dim = relationship("ServiceTag", lazy="joined")
+    domain_dim = relationship("Domain", lazy="joined")
+    country_dim = relationship("Country", lazy="joined")
+    city_dim = relationship("City", lazy="joined")
+    device_dim = relationship("Device", lazy="joined")
+    
+    campaign_name = association_proxy("campaign_dim", "campaign_name")
+    campaign_hash = association_proxy("campaign_dim", "campaign_hash")
+    service_tag = association_proxy("service_tag_dim", "value")
+    domain = association_proxy("domain_dim", "value")
+    country = association_proxy("country_dim", "value")
+    city = association_proxy("city_dim", "value")
+    device = association_proxy("device_dim", "value")
+    
+    dimension_fields = (
+        "campaign_name",
+        "campaign_hash",
+        "service_tag",
+        "domain",
+        "country",
+        "city",
+        "device",
+    )
+    
     def __repr__(self):
         return f"<CampaignEvent(campaign_name={self.campaign_name}, event_result={self.event_result})>"
     
     def __str__(self):
         return f"{self.campaign_name} - {self.event_result}"
     
+    @classmethod
+    def from_row(cls, row: dict):
+        """
+        Build a transient event from a flat row with decoded dimension
+        strings, as stored in archive segments.
+        """
+        row = dict(row)
+        return cls(
+            campaign_dim=Campaign(
+                campaign_hash=row.pop("campaign_hash", None),
+                campaign_name=row.pop("campaign_name", None),
+            ),
+            service_tag_dim=ServiceTag(value=row.pop("service_tag", None)),
+            domain_dim=Domain(value=row.pop("domain", None)),
+            country_dim=Country(value=row.pop("country", None)),
+            city_dim=City(value=row.pop("city", None)),
+            device_dim=Device(value=row.pop("device", None)),
+            **{key: value for key, value in row.items() if not key.endswith("_key")},
+        )
+    
     def model_dump(self):
         return {
             "id": self.id,
@@ -166,21 +307,27 @@ class CampaignEvent(Base):
 
 class AppEvent(Base):
     __tablename__ = "app_events"
+    __table_args__ = (
+        Index(
+            "ix_app_events_request_parameters",
+            "request_parameters",
+            postgresql_using="gin",
+            postgresql_ops={"request_parameters": "jsonb_path_ops"},
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     app_id = Column(Integer)
-    app_name = Column(String)
-    app_tags = Column(ARRAY(String))
-    app_hash = Column(String, index=True)
-    service_tag = Column(String)
+    app_key = Column(Integer, ForeignKey("apps.id"), index=True)
+    service_tag_key = Column(Integer, ForeignKey("service_tags.id"))
     
     clid = Column(String)
     appclid = Column(String)
-    request_parameters = Column(JSON)
+    request_parameters = Column(JSONB)
     user_ip = Column(String)
-    country = Column(String, index=True)
-    city = Column(String, index=True)
-    device = Column(String)
+    country_key = Column(Integer, ForeignKey("countries.id"), index=True)
+    city_key = Column(Integer, ForeignKey("cities.id"), index=True)
+    device_key = Column(Integer, ForeignKey("devices.id"))
     
     event_result = Column(String)
     deposit_amount = Column(Float)
@@ -190,12 +337,56 @@ class AppEvent(Base):
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
+    app_dim = relationship("App", lazy="joined")
+    service_tag_dim = relationship("ServiceTag", lazy="joined")
+    country_dim = relationship("Country", lazy="joined")
+    city_dim = relationship("City", lazy="joined")
+    device_dim = relationship("Device", lazy="joined")
+    
+    app_name = association_proxy("app_dim", "app_name")
+    app_tags = association_proxy("app_dim", "app_tags")
+    app_hash = association_proxy("app_dim", "app_hash")
+    service_tag = association_proxy("service_tag_dim", "value")
+    country = association_proxy("country_dim", "value")
+    city = association_proxy("city_dim", "value")
+    device = association_proxy("device_dim", "value")
+    
+    dimension_fields = (
+        "app_name",
+        "app_tags",
+        "app_hash",
+        "service_tag",
+        "country",
+        "city",
+        "device",
+    )
+    
     def __repr__(self):
         return f"<AppEvent(name={self.app_name}, panel_id={self.event_result})>"
     
     def __str__(self):
         return f"{self.app_name} - {self.event_result}"
     
+    @classmethod
+    def from_row(cls, row: dict):
+        """
+        Build a transient event from a flat row with decoded dimension
+        strings, as stored in archive segments.
+        """
+        row = dict(row)
+        return cls(
+            app_dim=App(
+                app_hash=row.pop("app_hash", None),
+                app_name=row.pop("app_name", None),
+                app_tags=row.pop("app_tags", None),
+            ),
+            service_tag_dim=ServiceTag(value=row.pop("service_tag", None)),
+            country_dim=Country(value=row.pop("country", None)),
+            city_dim=City(value=row.pop("city", None)),
+            device_dim=Device(value=row.pop("device", None)),
+            **{key: value for key, value in row.items() if not key.endswith("_key")},
+        )
+    
     def model_dump(self):
         return {
             "id": self.id,
@@ -214,4 +405,380 @@ class AppEvent(Base):
         }
 
 
-Base.metadata.create_all(bind=engine)
+class ViewRefresh(Base):
+    __tablename__ = "view_refreshes"
+
+    name = Column(String, primary_key=True)
+    refreshed_at = Column(DateTime(timezone=True))
+    
+    def __repr__(self):
+        return f"<ViewRefresh(name={self.name}, refreshed_at={self.refreshed_at})>"
+    
+    def model_dump(self):
+        return {
+            "name": self.name,
+            "refreshed_at": self.refreshed_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class PanelPush(Base):
+    """
+    Running totals of the statistics pushed to a panel, one row per panel.
+    """
+    __tablename__ = "panel_pushes"
+
+    panel_id = Column(Integer, ForeignKey("panels.id"), primary_key=True)
+    users_pushed = Column(BigInteger, default=0)
+    batches_pushed = Column(Integer, default=0)
+    last_pushed_at = Column(DateTime(timezone=True))
+    
+    def __repr__(self):
+        return f"<PanelPush(panel_id={self.panel_id}, users_pushed={self.users_pushed})>"
+    
+    def model_dump(self):
+        return {
+            "panel_id": self.panel_id,
+            "users_pushed": self.users_pushed,
+            "batches_pushed": self.batches_pushed,
+            "last_pushed_at": self.last_pushed_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class ArchiveSegment(Base):
+    __tablename__ = "archive_segments"
+    __table_args__ = (
+        Index(
+            "ix_archive_segments_lookup",
+            "table_name",
+            "service_tag",
+            "max_created_at",
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String)
+    service_tag = Column(String)
+    path = Column(String)
+    row_count = Column(Integer)
+    min_created_at = Column(DateTime(timezone=True))
+    max_created_at = Column(DateTime(timezone=True))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<ArchiveSegment(table_name={self.table_name}, service_tag={self.service_tag}, path={self.path})>"
+    
+    def __str__(self):
+        return f"{self.table_name} ({self.service_tag}) - {self.path}"
+    
+    def model_dump(self):
+        return {
+            "id": self.id,
+            "table_name": self.table_name,
+            "service_tag": self.service_tag,
+            "path": self.path,
+            "row_count": self.row_count,
+            "min_created_at": self.min_created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "max_created_at": self.max_created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "created_at": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+# Materialized aggregate views used by breakdown queries. They live in their
+# own metadata so that create_all does not try to create them as tables.
+view_metadata = MetaData()
+
+campaign_event_breakdown = Table(
+    "campaign_event_breakdown",
+    view_metadata,
+    Column("user_id", Integer),
+    Column("service_tag", String),
+    Column("campaign_hash", String),
+    Column("event_result", String),
+    Column("country", String),
+    Column("city", String),
+    Column("device", String),
+    Column("domain", String),
+    Column("day", Date),
+    Column("total", BigInteger),
+)
+
+app_event_breakdown = Table(
+    "app_event_breakdown",
+    view_metadata,
+    Column("user_id", Integer),
+    Column("service_tag", String),
+    Column("app_hash", String),
+    Column("event_result", String),
+    Column("country", String),
+    Column("city", String),
+    Column("device", String),
+    Column("day", Date),
+    Column("total", BigInteger),
+    Column("deposit_amount", Float),
+)
+
+# Dimensions are coalesced to '' so every row is covered by the unique index
+# that REFRESH MATERIALIZED VIEW CONCURRENTLY requires.
+BREAKDOWN_VIEWS = {
+    "campaign_event_breakdown": """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS campaign_event_breakdown AS
+        SELECT
+            e.user_id,
+            COALESCE(s.value, '') AS service_tag,
+            COALESCE(c.campaign_hash, '') AS campaign_hash,
+            COALESCE(e.event_result, '') AS event_result,
+            COALESCE(co.value, '') AS country,
+            COALESCE(ci.value, '') AS city,
+            COALESCE(dv.value, '') AS device,
+            COALESCE(d.value, '') AS domain,
+            CAST(e.created_at AS DATE) AS day,
+            COUNT(*) AS total
+        FROM campaign_events e
+        LEFT JOIN service_tags s ON s.id = e.service_tag_key
+        LEFT JOIN campaigns c ON c.id = e.campaign_key
+        LEFT JOIN countries co ON co.id = e.country_key
+        LEFT JOIN cities ci ON ci.id = e.city_key
+        LEFT JOIN devices dv ON dv.id = e.device_key
+        LEFT JOIN domains d ON d.id = e.domain_key
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9
+    """,
+    "app_event_breakdown": """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS app_event_breakdown AS
+        SELECT
+            e.user_id,
+            COALESCE(s.value, '') AS service_tag,
+            COALESCE(a.app_hash, '') AS app_hash,
+            COALESCE(e.event_result, '') AS event_result,
+            COALESCE(co.value, '') AS country,
+            COALESCE(ci.value, '') AS city,
+            COALESCE(dv.value, '') AS device,
+            CAST(e.created_at AS DATE) AS day,
+            COUNT(*) AS total,
+            SUM(e.deposit_amount) AS deposit_amount
+        FROM app_events e
+        LEFT JOIN service_tags s ON s.id = e.service_tag_key
+        LEFT JOIN apps a ON a.id = e.app_key
+        LEFT JOIN countries co ON co.id = e.country_key
+        LEFT JOIN cities ci ON ci.id = e.city_key
+        LEFT JOIN devices dv ON dv.id = e.device_key
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+    """,
+}
+
+BREAKDOWN_VIEW_INDEXES = {
+    "campaign_event_breakdown": """
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_campaign_event_breakdown_key
+        ON campaign_event_breakdown (
+            user_id, service_tag, campaign_hash, event_result,
+            country, city, device, domain, day
+        )
+    """,
+    "app_event_breakdown": """
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_app_event_breakdown_key
+        ON app_event_breakdown (
+            user_id, service_tag, app_hash, event_result,
+            country, city, device, day
+        )
+    """,
+}
+
+
+def table_storage(connection, table: str) -> dict:
+    rows, table_size, index_size, total_size = connection.execute(
+        text(
+            "SELECT reltuples, pg_relation_size(oid), pg_indexes_size(oid), "
+            "pg_total_relation_size(oid) FROM pg_class WHERE relname = :table"
+        ),
+        {"table": table},
+    ).one()
+    return {
+        "rows": max(int(rows), 0),
+        "table_bytes": table_size,
+        "index_bytes": index_size,
+        "total_bytes": total_size,
+        "bytes_per_row": round(table_size / rows, 1) if rows > 0 else None,
+    }
+
+
+# pg_advisory_xact_lock key that keeps the schema setup every worker runs on
+# import from racing between workers
+SCHEMA_LOCK_KEY = 2029
+
+
+@contextmanager
+def schema_transaction():
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY}
+        )
+        yield connection
+
+
+def create_schema():
+    with schema_transaction() as connection:
+        Base.metadata.create_all(bind=connection)
+
+
+def create_breakdown_views():
+    with schema_transaction() as connection:
+        for name, statement in BREAKDOWN_VIEWS.items():
+            connection.execute(text(statement))
+            connection.execute(text(BREAKDOWN_VIEW_INDEXES[name]))
+
+
+def migrate_request_parameters():
+    # Tables created before request_parameters became JSONB still hold JSON
+    # columns without the GIN index; convert them in place.
+    with schema_transaction() as connection:
+        for table in ("campaign_events", "app_events"):
+            data_type = connection.execute(
+                text(
+                    "SELECT data_type FROM information_schema.columns "
+                    "WHERE table_name = :table AND column_name = 'request_parameters'"
+                ),
+                {"table": table},
+            ).scalar()
+            if data_type == "json":
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table} ALTER COLUMN request_parameters "
+                        f"TYPE JSONB USING request_parameters::jsonb"
+                    )
+                )
+            connection.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_request_parameters "
+                    f"ON {table} USING gin (request_parameters jsonb_path_ops)"
+                )
+            )
+
+
+# (table, dimension table, column) for every single-string dimension
+SIMPLE_DIMENSIONS = (
+    ("campaign_events", "service_tags", "service_tag"),
+    ("campaign_events", "domains", "domain"),
+    ("campaign_events", "countries", "country"),
+    ("campaign_events", "cities", "city"),
+    ("campaign_events", "devices", "device"),
+    ("app_events", "service_tags", "service_tag"),
+    ("app_events", "countries", "country"),
+    ("app_events", "cities", "city"),
+    ("app_events", "devices", "device"),
+)
+
+# (table, dimension table, key column, columns) for multi-column dimensions;
+# the first column is the hash the rows are matched on
+COMPOSITE_DIMENSIONS = (
+    (
+        "campaign_events",
+        "campaigns",
+        "campaign_key",
+        ("campaign_hash", "campaign_name"),
+    ),
+    ("app_events", "apps", "app_key", ("app_hash", "app_name", "app_tags")),
+)
+
+
+def migrate_dimension_keys():
+    # Tables created before dictionary encoding still carry the plain string
+    # columns; move their values into the dimension tables and replace the
+    # columns with surrogate keys.
+    def find_legacy_tables(connection) -> set:
+        return {
+            table
+            for (table,) in connection.execute(
+                text(
+                    "SELECT table_name FROM information_schema.columns "
+                    "WHERE table_name IN ('campaign_events', 'app_events') "
+                    "AND column_name = 'service_tag'"
+                )
+            )
+        }
+
+    with engine.begin() as connection:
+        if not find_legacy_tables(connection):
+            return
+
+    # the first worker to get the lock migrates; the others see no legacy
+    # columns left once it is released
+    with schema_transaction() as connection:
+        legacy_tables = find_legacy_tables(connection)
+        if not legacy_tables:
+            return
+        
+        storage_before = {}
+        for table in sorted(legacy_tables):
+            connection.execute(text(f"ANALYZE {table}"))
+            storage_before[table] = table_storage(connection, table)
+        
+        for name in BREAKDOWN_VIEWS:
+            connection.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {name}"))
+        
+        for table, dimension, column in SIMPLE_DIMENSIONS:
+            if table not in legacy_tables:
+                continue
+            connection.execute(text(
+                f"INSERT INTO {dimension} (value) "
+                f"SELECT DISTINCT {column} FROM {table} WHERE {column} IS NOT NULL "
+                f"ON CONFLICT (value) DO NOTHING"
+            ))
+            connection.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}_key "
+                f"INTEGER REFERENCES {dimension} (id)"
+            ))
+            connection.execute(text(
+                f"UPDATE {table} e SET {column}_key = d.id FROM {dimension} d "
+                f"WHERE d.value = e.{column}"
+            ))
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        
+        for table, dimension, key, columns in COMPOSITE_DIMENSIONS:
+            if table not in legacy_tables:
+                continue
+            column_list = ", ".join(columns)
+            connection.execute(text(
+                f"INSERT INTO {dimension} ({column_list}) "
+                f"SELECT DISTINCT {column_list} FROM {table} "
+                f"ON CONFLICT DO NOTHING"
+            ))
+            connection.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {key} "
+                f"INTEGER REFERENCES {dimension} (id)"
+            ))
+            # IS NOT DISTINCT FROM can not drive a hash join, so match on the
+            # hash first and compare the NULL-able parts only on those pairs
+            connection.execute(text(
+                f"UPDATE {table} e SET {key} = d.id FROM {dimension} d "
+                f"WHERE COALESCE(d.{columns[0]}, '') = COALESCE(e.{columns[0]}, '') AND "
+                + " AND ".join(
+                    f"d.{column} IS NOT DISTINCT FROM e.{column}"
+                    for column in columns
+                )
+            ))
+            for column in columns:
+                connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        
+        # indexes declared on the models, which create_all skipped for
+        # the already existing tables
+        for model in (CampaignEvent, AppEvent):
+            if model.__tablename__ in legacy_tables:
+                for index in model.__table__.indexes:
+                    index.create(connection, checkfirst=True)
+    
+    # DROP COLUMN leaves the old values in the heap pages; rewrite the tables
+    # so the smaller rows actually take less space.
+    with engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as connection:
+        for table in sorted(legacy_tables):
+            connection.execute(text(f"VACUUM FULL ANALYZE {table}"))
+            logs.info(
+                f"Dictionary encoded {table}: {storage_before[table]} -> "
+                f"{table_storage(connection, table)}"
+            )
+
+
+create_schema()
+migrate_request_parameters()
+migrate_dimension_keys()
+create_breakdown_views()
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubPanelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.received.append((self.path, time.monotonic(), body))
+            statuses = server.statuses.get(self.path, [(200, {})])
+            status, headers = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPanel:
+    """
+    Local HTTP server standing in for panels. statuses maps a path to the
+    (status, headers) replies it gives in turn, repeating the last one;
+    unknown paths get 200.
+    """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubPanelHandler)
+        self.server.lock = threading.Lock()
+        self.server.received = []
+        self.server.statuses = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def statuses(self) -> dict:
+        return self.server.statuses
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_port}"
+
+    def url(self, path: str) -> str:
+        return f"http://{self.host}{path}"
+
+    def received(self, path: str) -> list:
+        with self.server.lock:
+            return [item for item in self.server.received if item[0] == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
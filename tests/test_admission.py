@@ -0,0 +1,153 @@
+import asyncio
+import unittest
+
+from utils.admission import AdmissionController, Overloaded
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    def controller(self, **overrides) -> AdmissionController:
+        settings = {
+            "max_concurrent": 1,
+            "max_queue": 10,
+            "max_queue_per_tag": 10,
+            "queue_timeout": 1,
+            "retry_after": 3,
+        }
+        settings.update(overrides)
+        return AdmissionController(**settings)
+
+    async def settle(self):
+        # let queued acquires reach their waiter
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_serves_service_tags_round_robin(self):
+        admission = self.controller()
+        order = []
+        release = asyncio.Event()
+
+        async def work(service_tag: str, name: str):
+            async with admission.slot(service_tag):
+                order.append(name)
+                await release.wait()
+
+        holder = asyncio.create_task(work("noisy", "holder"))
+        await self.settle()
+        tasks = [
+            asyncio.create_task(work(service_tag, name))
+            for service_tag, name in (
+                ("noisy", "noisy-1"),
+                ("noisy", "noisy-2"),
+                ("noisy", "noisy-3"),
+                ("quiet", "quiet-1"),
+                ("other", "other-1"),
+            )
+        ]
+        await self.settle()
+        self.assertEqual(admission.queued, 5)
+
+        release.set()
+        await asyncio.gather(holder, *tasks)
+
+        self.assertEqual(
+            order,
+            ["holder", "noisy-1", "quiet-1", "other-1", "noisy-2", "noisy-3"],
+        )
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.queued, 0)
+
+    async def test_sheds_full_service_tag_queue_with_429(self):
+        admission = self.controller(max_queue_per_tag=1)
+        await admission.acquire("noisy")
+        queued = asyncio.create_task(admission.acquire("noisy"))
+        await self.settle()
+
+        with self.assertRaises(Overloaded) as shed:
+            await admission.acquire("noisy")
+
+        self.assertEqual(shed.exception.status_code, 429)
+        self.assertEqual(shed.exception.reason, "tag_queue_full")
+        self.assertEqual(shed.exception.retry_after, 3)
+        # other service tags can still queue
+        other = asyncio.create_task(admission.acquire("quiet"))
+        await self.settle()
+        self.assertEqual(admission.queued, 2)
+
+        for _ in range(3):
+            admission.release()
+        await asyncio.gather(queued, other)
+        self.assertEqual(admission.in_flight, 0)
+
+    async def test_sheds_full_queue_with_503(self):
+        admission = self.controller(max_queue=1)
+        await admission.acquire("noisy")
+        queued = asyncio.create_task(admission.acquire("noisy"))
+        await self.settle()
+
+        with self.assertRaises(Overloaded) as shed:
+            await admission.acquire("quiet")
+
+        self.assertEqual(shed.exception.status_code, 503)
+        self.assertEqual(shed.exception.reason, "queue_full")
+
+        admission.release()
+        await queued
+        admission.release()
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(
+            admission.model_dump()["shed"], {"quiet": {"queue_full": 1}}
+        )
+
+    async def test_sheds_on_queue_timeout_and_frees_the_slot(self):
+        admission = self.controller(queue_timeout=0.05)
+        await admission.acquire("noisy")
+
+        with self.assertRaises(Overloaded) as shed:
+            await admission.acquire("quiet")
+
+        self.assertEqual(shed.exception.status_code, 503)
+        self.assertEqual(shed.exception.reason, "queue_timeout")
+        self.assertEqual(admission.queued, 0)
+
+        admission.release()
+        self.assertEqual(admission.in_flight, 0)
+
+    async def test_cancel_while_queued_leaves_no_waiter(self):
+        admission = self.controller()
+        await admission.acquire("noisy")
+        queued = asyncio.create_task(admission.acquire("quiet"))
+        await self.settle()
+
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+
+        self.assertEqual(admission.queued, 0)
+        admission.release()
+        self.assertEqual(admission.in_flight, 0)
+
+    async def test_cancel_after_handover_releases_the_slot(self):
+        admission = self.controller()
+        await admission.acquire("noisy")
+        queued = asyncio.create_task(admission.acquire("quiet"))
+        await self.settle()
+
+        # the slot is handed over, then the waiting request is cancelled
+        # before it could run; depending on the Python version wait_for
+        # either returns the slot or raises and gives it back
+        admission.release()
+        queued.cancel()
+        try:
+            await queued
+            admission.release()
+        except asyncio.CancelledError:
+            pass
+
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.queued, 0)
+        await admission.acquire("noisy")
+        self.assertEqual(admission.in_flight, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
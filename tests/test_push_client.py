@@ -0,0 +1,96 @@
+import socket
+import time
+import unittest
+
+from stub_panel import StubPanel
+from utils.push_client import PushClient, DELIVERED, RETRY, REJECTED
+
+
+class PushClientTest(unittest.TestCase):
+    def setUp(self):
+        self.panel = StubPanel()
+        self.client = PushClient(
+            workers=2,
+            pool_hosts=2,
+            timeout=5,
+            max_retries=2,
+            backoff=0.01,
+            max_backoff=2,
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.panel.close()
+
+    def test_batches(self):
+        self.panel.statuses["/ok"] = [(200, {})]
+        users = ["a", "b", "c", "d", "e"]
+        batches = PushClient.batches(users, 2)
+
+        outcomes = self.client.deliver_all(
+            [(self.panel.url("/ok"), {"statistics": batch}) for batch in batches]
+        )
+
+        self.assertEqual(batches, [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEqual(outcomes, [DELIVERED] * 3)
+        self.assertEqual(
+            sorted(body["statistics"] for _, _, body in self.panel.received("/ok")),
+            batches,
+        )
+
+    def test_retries_after_503_honouring_retry_after(self):
+        self.panel.statuses["/busy"] = [(503, {"Retry-After": "1"}), (200, {})]
+
+        outcome = self.client.deliver(self.panel.url("/busy"), {"statistics": []})
+
+        attempts = self.panel.received("/busy")
+        self.assertEqual(outcome, DELIVERED)
+        self.assertEqual(len(attempts), 2)
+        self.assertGreaterEqual(attempts[1][1] - attempts[0][1], 1)
+
+    def test_long_retry_after_is_left_to_the_next_push(self):
+        self.panel.statuses["/later"] = [(503, {"Retry-After": "3600"}), (200, {})]
+
+        started = time.monotonic()
+        outcome = self.client.deliver(self.panel.url("/later"), {"statistics": []})
+
+        self.assertEqual(outcome, RETRY)
+        self.assertEqual(len(self.panel.received("/later")), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_retries_after_429(self):
+        self.panel.statuses["/limited"] = [(429, {}), (200, {})]
+
+        outcome = self.client.deliver(self.panel.url("/limited"), {"statistics": []})
+
+        self.assertEqual(outcome, DELIVERED)
+        self.assertEqual(len(self.panel.received("/limited")), 2)
+
+    def test_gives_up_after_max_retries(self):
+        self.panel.statuses["/down"] = [(503, {})]
+
+        outcome = self.client.deliver(self.panel.url("/down"), {"statistics": []})
+
+        self.assertEqual(outcome, RETRY)
+        self.assertEqual(len(self.panel.received("/down")), 3)
+
+    def test_client_error_is_not_retried(self):
+        self.panel.statuses["/missing"] = [(404, {})]
+
+        outcome = self.client.deliver(self.panel.url("/missing"), {"statistics": []})
+
+        self.assertEqual(outcome, REJECTED)
+        self.assertEqual(len(self.panel.received("/missing")), 1)
+
+    def test_connection_error_is_retried(self):
+        with socket.socket() as closed:
+            closed.bind(("127.0.0.1", 0))
+            port = closed.getsockname()[1]
+
+        outcome = self.client.deliver(f"http://127.0.0.1:{port}/", {"statistics": []})
+
+        self.assertEqual(outcome, RETRY)
+
+
+if __name__ == "__main__":
+    unittest.main()
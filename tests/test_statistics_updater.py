@@ -0,0 +1,159 @@
+import unittest
+from types import SimpleNamespace
+
+from stub_panel import StubPanel
+from utils.statistics_updater import StatisticsUpdater
+
+
+class FakeSession:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCollector:
+    """
+    Stands in for Collector: panels come from a list, statistics are the
+    user hashes themselves and recorded pushes are kept in memory.
+    """
+
+    def __init__(self, panels: list):
+        self.panels = panels
+        self.session = FakeSession()
+        self.batches = []
+        self.pushes = []
+        self.fail_statistics = False
+        self.fail_record = False
+
+    def __call__(self, session):
+        return self
+
+    def active_panels(self, service_tags: list, panel_ids: list) -> list:
+        return [
+            panel
+            for panel in self.panels
+            if panel.service_tag in service_tags or panel.id in panel_ids
+        ]
+
+    def generate_batch_user_statistics(self, data: list) -> list:
+        if self.fail_statistics:
+            raise RuntimeError("database went away")
+        self.batches.append([item.user_hash for item in data])
+        return [{"user_hash": item.user_hash} for item in data]
+
+    def record_push(self, panel_id: int, users: int):
+        if self.fail_record:
+            raise RuntimeError("database went away")
+        self.pushes.append((panel_id, users))
+
+
+class StatisticsUpdaterTest(unittest.TestCase):
+    def setUp(self):
+        self.panel = StubPanel()
+        self.collector = FakeCollector(
+            [
+                SimpleNamespace(id=1, service_tag="alpha", domain=f"{self.panel.host}/one"),
+                SimpleNamespace(id=2, service_tag="alpha", domain=f"{self.panel.host}/two"),
+                SimpleNamespace(id=3, service_tag="beta", domain=f"{self.panel.host}/three"),
+            ]
+        )
+        self.updater = StatisticsUpdater(
+            self.collector,
+            url_template="http://{domain}/statistics",
+            period="month",
+            batch_size=2,
+            workers=2,
+            pool_hosts=4,
+            timeout=5,
+            max_retries=0,
+            backoff=0.01,
+            max_backoff=1,
+        )
+
+    def tearDown(self):
+        self.updater.close()
+        self.panel.close()
+
+    def pushed_users(self, path: str) -> list:
+        return sorted(
+            item["user_hash"]
+            for _, _, body in self.panel.received(path)
+            for item in body["statistics"]
+        )
+
+    def test_coalesces_changes_per_service_tag(self):
+        for user_hash in ("a", "b", "c", "a", "a"):
+            self.updater.mark_changed("alpha", user_hash)
+
+        self.updater.push(None)
+
+        self.assertEqual(self.pushed_users("/one/statistics"), ["a", "b", "c"])
+        self.assertEqual(self.pushed_users("/two/statistics"), ["a", "b", "c"])
+        self.assertEqual(self.panel.received("/three/statistics"), [])
+        self.assertEqual(len(self.panel.received("/one/statistics")), 2)
+        # both panels of the tag share the statistics of each batch
+        self.assertEqual(self.collector.batches, [["a", "b"], ["c"]])
+        self.assertEqual(
+            sorted(self.collector.pushes), [(1, 1), (1, 2), (2, 1), (2, 2)]
+        )
+        self.assertEqual((self.updater.changed, self.updater.retries), ({}, {}))
+
+    def test_requeues_only_retryable_failures_per_panel(self):
+        self.panel.statuses["/one/statistics"] = [(503, {}), (200, {})]
+        self.panel.statuses["/two/statistics"] = [(404, {})]
+        self.updater.mark_changed("alpha", "a")
+
+        self.updater.push(None)
+
+        self.assertEqual(self.updater.retries, {1: {"a"}})
+        self.assertEqual(self.updater.changed, {})
+        self.assertEqual(self.collector.pushes, [])
+
+        self.updater.push(None)
+
+        self.assertEqual(len(self.panel.received("/one/statistics")), 2)
+        self.assertEqual(len(self.panel.received("/two/statistics")), 1)
+        self.assertEqual(self.collector.pushes, [(1, 1)])
+        self.assertEqual(self.updater.retries, {})
+
+    def test_merges_retries_with_new_changes(self):
+        self.panel.statuses["/three/statistics"] = [(503, {}), (200, {})]
+        self.updater.mark_changed("beta", "a")
+        self.updater.push(None)
+
+        self.updater.mark_changed("beta", "b")
+        self.updater.push(None)
+
+        bodies = [body for _, _, body in self.panel.received("/three/statistics")]
+        self.assertEqual(
+            [item["user_hash"] for item in bodies[-1]["statistics"]], ["a", "b"]
+        )
+        self.assertEqual((self.updater.changed, self.updater.retries), ({}, {}))
+
+    def test_keeps_pending_work_when_push_fails(self):
+        self.updater.mark_changed("alpha", "a")
+        self.updater.retries[3] = {"b"}
+        self.collector.fail_statistics = True
+
+        with self.assertRaises(RuntimeError):
+            self.updater.push(None)
+
+        self.assertEqual(self.updater.changed, {"alpha": {"a"}})
+        self.assertEqual(self.updater.retries, {3: {"b"}})
+        self.assertEqual(self.panel.server.received, [])
+
+    def test_failed_record_is_rolled_back_and_not_resent(self):
+        self.collector.fail_record = True
+        self.updater.mark_changed("beta", "a")
+
+        self.updater.push(None)
+
+        self.assertEqual(len(self.panel.received("/three/statistics")), 1)
+        self.assertEqual(self.collector.session.rollbacks, 1)
+        self.assertEqual((self.updater.changed, self.updater.retries), ({}, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
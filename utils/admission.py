@@ -0,0 +1,118 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from utils import logger
+
+
+logs = logger.get_logger(__name__)
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests working at the same time. Requests over
+    the limit wait in per-service_tag queues that are served round-robin,
+    so one noisy panel can not starve the others. Requests that can not be
+    queued are shed: 429 when their own service_tag queue is full, 503 when
+    the whole queue is full or the wait times out.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queue: int,
+        max_queue_per_tag: int,
+        queue_timeout: float,
+        retry_after: int,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_tag = max_queue_per_tag
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self.in_flight = 0
+        self.waiters = OrderedDict()
+        self.metrics = {"admitted": 0, "shed": {}}
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+    @asynccontextmanager
+    async def slot(self, service_tag: str):
+        await self.acquire(service_tag)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, service_tag: str):
+        if self.in_flight < self.max_concurrent and not self.waiters:
+            self.in_flight += 1
+            self.metrics["admitted"] += 1
+            return
+
+        if self.queued >= self.max_queue:
+            self.shed(service_tag, 503, "queue_full")
+        if len(self.waiters.get(service_tag, ())) >= self.max_queue_per_tag:
+            self.shed(service_tag, 429, "tag_queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(service_tag, deque()).append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.discard(service_tag, waiter)
+            self.shed(service_tag, 503, "queue_timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            else:
+                self.discard(service_tag, waiter)
+            raise
+        self.metrics["admitted"] += 1
+
+    def release(self):
+        # hand the slot over to the next service_tag in turn, if any waits
+        while self.waiters:
+            service_tag, tag_waiters = self.waiters.popitem(last=False)
+            waiter = tag_waiters.popleft()
+            if tag_waiters:
+                self.waiters[service_tag] = tag_waiters
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def discard(self, service_tag: str, waiter):
+        tag_waiters = self.waiters.get(service_tag)
+        if tag_waiters and waiter in tag_waiters:
+            tag_waiters.remove(waiter)
+            if not tag_waiters:
+                del self.waiters[service_tag]
+
+    def shed(self, service_tag: str, status_code: int, reason: str):
+        shed = self.metrics["shed"].setdefault(service_tag, {})
+        shed[reason] = shed.get(reason, 0) + 1
+        logs.warning(f"Shedding request of {service_tag}: {reason}")
+        raise Overloaded(status_code, reason, self.retry_after)
+
+    def model_dump(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.metrics["admitted"],
+            "shed": self.metrics["shed"],
+        }
@@ -0,0 +1,280 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from config import ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+from models import ArchiveSegment, CampaignEvent, AppEvent, ServiceTag, engine
+from utils import logger
+
+
+logs = logger.get_logger(__name__)
+
+ARCHIVED_MODELS = (CampaignEvent, AppEvent)
+
+# pg_advisory_lock key that keeps archive runs of several workers apart
+ARCHIVE_LOCK_KEY = 2028
+
+
+class Archiver:
+    """
+    Moves old events out of the hot tables into gzipped NDJSON segment
+    files. Every segment holds rows of one table and one service_tag and
+    is registered in archive_segments with its time range, so readers can
+    skip segments that fall outside the requested period.
+    """
+
+    def __init__(self, session: sessionmaker, archive_dir: str = ARCHIVE_DIR):
+        self.session = session
+        self.archive_dir = archive_dir
+
+    def archive_events(self, older_than_days: int = ARCHIVE_AFTER_DAYS):
+        # The lock is held on a connection of its own, the session hands its
+        # connection back to the pool on every commit.
+        with engine.connect() as lock_connection:
+            locked = lock_connection.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": ARCHIVE_LOCK_KEY}
+            ).scalar()
+            if not locked:
+                logs.info("Archiving is already running in another worker")
+                return
+            try:
+                self.archive_old_events(older_than_days)
+            finally:
+                lock_connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": ARCHIVE_LOCK_KEY}
+                )
+
+    def archive_old_events(self, older_than_days: int):
+        cutoff = self.hot_window_start(older_than_days)
+        logs.info(f"Archiving events created before {cutoff}")
+
+        for model in ARCHIVED_MODELS:
+            service_tags = (
+                self.session.query(ServiceTag)
+                .filter(
+                    ServiceTag.id.in_(
+                        self.session.query(model.service_tag_key)
+                        .filter(model.created_at < cutoff)
+                        .distinct()
+                    )
+                )
+                .all()
+            )
+            for service_tag in service_tags:
+                while self.archive_segment(model, service_tag, cutoff):
+                    pass
+
+    @staticmethod
+    def hot_window_start(older_than_days: int = ARCHIVE_AFTER_DAYS) -> datetime:
+        """
+        Events created before this moment may already be in the archive.
+        """
+        return datetime.now(timezone.utc) - timedelta(days=older_than_days)
+
+    def archive_segment(self, model, service_tag: ServiceTag, cutoff: datetime) -> int:
+        events = (
+            self.session.query(model)
+            .filter(model.service_tag_key == service_tag.id)
+            .filter(model.created_at < cutoff)
+            .order_by(model.id)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .all()
+        )
+        if not events:
+            return 0
+
+        table_name = model.__tablename__
+        # the directory is named after the dimension id, the tag itself comes
+        # from ingest and is kept only in archive_segments
+        directory = os.path.join(self.archive_dir, table_name, str(service_tag.id))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f"{events[0].id}-{events[-1].id}.ndjson.gz"
+        )
+
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as segment:
+            for event in events:
+                segment.write(json.dumps(self.dump_row(event)) + "\n")
+        os.replace(tmp_path, path)
+
+        self.session.add(
+            ArchiveSegment(
+                table_name=table_name,
+                service_tag=service_tag.value,
+                path=path,
+                row_count=len(events),
+                min_created_at=min(event.created_at for event in events),
+                max_created_at=max(event.created_at for event in events),
+            )
+        )
+        (
+            self.session.query(model)
+            .filter(model.id.in_([event.id for event in events]))
+            .delete(synchronize_session=False)
+        )
+        try:
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            os.remove(path)
+            raise
+
+        logs.info(f"Archived {len(events)} {table_name} rows to {path}")
+        return len(events)
+
+    def read_events(
+        self,
+        model,
+        service_tag: str,
+        user_id: int,
+        period_start: datetime,
+        filters: dict = None,
+        request_parameters: dict = None,
+    ) -> list:
+        """
+        Return archived events of a user as transient model instances, so
+        they can be handled the same way as rows from the hot tables.
+        """
+        period_start = self.aware(period_start)
+
+        segments = (
+            self.session.query(ArchiveSegment)
+            .filter(ArchiveSegment.table_name == model.__tablename__)
+            .filter(ArchiveSegment.service_tag == service_tag)
+            .filter(ArchiveSegment.max_created_at >= period_start)
+            .order_by(ArchiveSegment.min_created_at)
+            .all()
+        )
+
+        return [
+            model.from_row(row)
+            for row in self.iter_rows(segments)
+            if row["user_id"] == user_id
+            and self.matches(row, period_start, filters, request_parameters)
+        ]
+
+    def count_events(
+        self, model, user_filters: dict, first_hot_ids: dict = None
+    ) -> dict:
+        """
+        Count archived events of many users in one pass over the segments.
+        user_filters maps user_id to (service_tag, period_start, filters,
+        request_parameters); the result maps (user_id, event_result) to
+        the number of matching events. Rows with an id at or above the
+        user's entry in first_hot_ids were still counted in the hot table.
+        """
+        first_hot_ids = first_hot_ids or {}
+        if not user_filters:
+            return {}
+        user_filters = {
+            user_id: (service_tag, self.aware(period_start), filters, parameters)
+            for user_id, (service_tag, period_start, filters, parameters)
+            in user_filters.items()
+        }
+
+        segments = (
+            self.session.query(ArchiveSegment)
+            .filter(ArchiveSegment.table_name == model.__tablename__)
+            .filter(
+                ArchiveSegment.service_tag.in_(
+                    {service_tag for service_tag, *_ in user_filters.values()}
+                )
+            )
+            .filter(
+                ArchiveSegment.max_created_at
+                >= min(period_start for _, period_start, *_ in user_filters.values())
+            )
+            .all()
+        )
+
+        counts = {}
+        for row in self.iter_rows(segments):
+            if row["user_id"] not in user_filters:
+                continue
+            service_tag, period_start, filters, request_parameters = user_filters[
+                row["user_id"]
+            ]
+            if row.get("service_tag") != service_tag:
+                continue
+            if row["id"] >= first_hot_ids.get(row["user_id"], row["id"] + 1):
+                continue
+            if not self.matches(row, period_start, filters, request_parameters):
+                continue
+            key = (row["user_id"], row["event_result"])
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    @staticmethod
+    def aware(moment: datetime) -> datetime:
+        # period starts may be naive local times, segment times are aware
+        return moment if moment.tzinfo else moment.astimezone()
+
+    @staticmethod
+    def iter_rows(segments):
+        for segment in segments:
+            with gzip.open(segment.path, "rt", encoding="utf-8") as lines:
+                for line in lines:
+                    row = json.loads(line)
+                    row["created_at"] = datetime.fromisoformat(row["created_at"])
+                    yield row
+
+    @classmethod
+    def matches(
+        cls,
+        row: dict,
+        period_start: datetime,
+        filters: dict = None,
+        request_parameters: dict = None,
+    ) -> bool:
+        if row["created_at"] < period_start:
+            return False
+        if filters and any(row.get(key) != value for key, value in filters.items()):
+            return False
+        if request_parameters and not cls.contains(
+            row.get("request_parameters") or {}, request_parameters
+        ):
+            return False
+        return True
+
+    @staticmethod
+    def dump_row(event) -> dict:
+        # Segments store decoded dimension strings instead of surrogate keys,
+        # so they stay readable on their own.
+        row = {
+            column.name: getattr(event, column.name)
+            for column in event.__table__.columns
+            if not column.name.endswith("_key")
+        }
+        for field in event.dimension_fields:
+            row[field] = getattr(event, field)
+        row["created_at"] = row["created_at"].isoformat()
+        return row
+
+    @classmethod
+    def contains(cls, document, subset) -> bool:
+        """
+        Mirrors JSONB @> used on the hot tables: objects contain every key
+        of the subset with a contained value, arrays contain every element
+        of the subset in some element of theirs, scalars must be equal.
+        """
+        if isinstance(subset, dict):
+            return isinstance(document, dict) and all(
+                key in document and cls.contains(document[key], value)
+                for key, value in subset.items()
+            )
+        if isinstance(subset, list):
+            return isinstance(document, list) and all(
+                any(cls.contains(element, value) for element in document)
+                for value in subset
+            )
+        if isinstance(document, (dict, list)):
+            return False
+        # JSON true and false are not the numbers 1 and 0
+        if isinstance(document, bool) != isinstance(subset, bool):
+            return False
+        return document == subset
@@ -1,19 +1,64 @@
 from datetime import datetime, timedelta
 from hashlib import sha256
 
+from sqlalchemy import BigInteger, and_, cast, func, or_, select, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker
 
-from dataclass import CampaignEventData, AppEventData, FilterData
-from models import PanelUser, CampaignEvent, AppEvent
-from utils import logger
+from dataclass import CampaignEventData, AppEventData, FilterData, BreakdownFilterData
+from config import BATCH_STATISTICS_MAX_USERS, CURSOR_MAX_SEEN, CURSOR_SAFETY_WINDOW
+from models import (
+    Panel,
+    PanelUser,
+    CampaignEvent,
+    AppEvent,
+    App,
+    Campaign,
+    ServiceTag,
+    Domain,
+    Country,
+    City,
+    Device,
+    ViewRefresh,
+    PanelPush,
+    BREAKDOWN_VIEWS,
+    table_storage,
+    campaign_event_breakdown,
+    app_event_breakdown,
+)
+from utils import interner, logger
+from utils.archiver import Archiver
 
 
 logs = logger.get_logger(__name__)
 
+# event_result -> key in the statistics response
+CAMPAIGN_RESULTS = {
+    "emergency": "emergency",
+    "offer": "offer",
+    "landing": "landing",
+    "app": "app",
+}
+APP_RESULTS = {
+    "view": "view",
+    "install": "install",
+    "reg": "register",
+    "dep": "deposit",
+    "entry": "entry",
+    "rereg": "reregister",
+    "redep": "redeposit",
+}
+
+BREAKDOWN_DIMENSIONS = {
+    "campaign": ("country", "city", "device", "domain"),
+    "app": ("country", "city", "device"),
+}
+
 
 class Collector:
     def __init__(self, session: sessionmaker):
         self.session = session
+        self.archiver = Archiver(session)
     
     # def generate_user_hash(self, user_id: int, service_tag: str) -> str:
     #     return sha256(f"user{user_id}{service_tag}".encode()).hexdigest()[:12]
@@ -43,17 +88,20 @@ class Collector:
         campaign_event = CampaignEvent(
             user_id=user.id,
             campaign_id=data.campaign_id,
-            campaign_name=data.campaign_name,
-            campaign_hash=data.campaign_hash,
+            campaign_key=interner.get_key(
+                Campaign,
+                campaign_hash=data.campaign_hash,
+                campaign_name=data.campaign_name,
+            ),
             subuser_hash=data.subuser_hash,
-            service_tag=data.service_tag,
+            service_tag_key=interner.get_key(ServiceTag, value=data.service_tag),
             clid=data.clid,
-            domain=data.domain,
+            domain_key=interner.get_key(Domain, value=data.domain),
             request_parameters=data.request_parameters,
             user_ip=data.user_ip,
-            country=data.country,
-            city=data.city,
-            device=data.device,
+            country_key=interner.get_key(Country, value=data.country),
+            city_key=interner.get_key(City, value=data.city),
+            device_key=interner.get_key(Device, value=data.device),
             event_result=data.event_result,
             app_id=data.app_id,
             landing_id=data.landing_id,
@@ -71,17 +119,20 @@ class Collector:
         app_event = AppEvent(
             user_id=user.id,
             app_id=data.app_id,
-            app_name=data.app_name,
-            app_tags=data.app_tags,
-            app_hash=data.app_hash,
-            service_tag=data.service_tag,
+            app_key=interner.get_key(
+                App,
+                app_hash=data.app_hash,
+                app_name=data.app_name,
+                app_tags=data.app_tags,
+            ),
+            service_tag_key=interner.get_key(ServiceTag, value=data.service_tag),
             clid=data.clid,
             appclid=data.appclid,
             request_parameters=data.request_parameters,
             user_ip=data.user_ip,
-            country=data.country,
-            city=data.city,
-            device=data.device,
+            country_key=interner.get_key(Country, value=data.country),
+            city_key=interner.get_key(City, value=data.city),
+            device_key=interner.get_key(Device, value=data.device),
             event_result=data.event_result
         )
         self.session.add(app_event)
@@ -96,17 +147,20 @@ class Collector:
         app_event = AppEvent(
             user_id=user.id,
             app_id=data.app_id,
-            app_name=data.app_name,
-            app_tags=data.app_tags,
-            app_hash=data.app_hash,
-            service_tag=data.service_tag,
+            app_key=interner.get_key(
+                App,
+                app_hash=data.app_hash,
+                app_name=data.app_name,
+                app_tags=data.app_tags,
+            ),
+            service_tag_key=interner.get_key(ServiceTag, value=data.service_tag),
             clid=data.clid,
             appclid=data.appclid,
             request_parameters=data.request_parameters,
             user_ip=data.user_ip,
-            country=data.country,
-            city=data.city,
-            device=data.device,
+            country_key=interner.get_key(Country, value=data.country),
+            city_key=interner.get_key(City, value=data.city),
+            device_key=interner.get_key(Device, value=data.device),
             event_result="view"
         )
         self.session.add(app_event)
@@ -114,6 +168,93 @@ class Collector:
         
         logs.info(f"App view saved: {app_event}")
     
+    def get_period_start(self, period: str, default: datetime) -> datetime:
+        today = datetime.now()
+        if period == "day":
+            return today - timedelta(days=1)
+        elif period == "week":
+            return today - timedelta(weeks=1)
+        elif period == "month":
+            return today - timedelta(weeks=4)
+        elif period == "year":
+            return today - timedelta(weeks=52)
+        else:
+            return default
+    
+    def parse_cursor(self, cursor: str):
+        """
+        Split a "<campaign cursor>:<app cursor>" cursor. Each part is a
+        watermark id followed by the ids above it that were already
+        returned, all joined by dots, e.g. "120.123.127:80". A trailing "+"
+        marks a part whose id list was cut at CURSOR_MAX_SEEN. Without a
+        cursor both watermarks are 0.
+        """
+        if not cursor:
+            return (0, set(), False), (0, set(), False)
+        parts = cursor.split(":")
+        try:
+            if len(parts) != 2:
+                raise ValueError(cursor)
+            cursors = []
+            for part in parts:
+                truncated = part.endswith("+")
+                ids = [int(event_id) for event_id in part.rstrip("+").split(".")]
+                cursors.append((ids[0], set(ids[1:]), truncated))
+        except ValueError:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return tuple(cursors)
+    
+    def settled_watermark(self, query, model, horizon) -> int:
+        # Runs before the delta is fetched, so every row it counts is also
+        # visible to the fetch
+        return query.with_entities(func.max(model.id)).filter(
+            model.created_at < horizon
+        ).scalar()
+    
+    def make_cursor_part(
+        self, events, watermark: int, seen: set, settled: int, horizon
+    ) -> str:
+        """
+        Ids come from a sequence but commit out of order, so the watermark
+        only moves up to events older than the safety window (settled is the
+        highest such id in the hot table); by then every transaction holding
+        a smaller id has finished. Newer events are listed in the cursor so
+        the next delta does not return them again. At most CURSOR_MAX_SEEN
+        ids are listed, keeping a cursor part bounded however busy the user
+        is; the ids left out are returned again by the next delta.
+        """
+        watermark = max(
+            [watermark, settled or 0]
+            + [event.id for event in events if event.created_at < horizon]
+        )
+        seen = sorted(
+            event_id
+            for event_id in seen | {event.id for event in events}
+            if event_id > watermark
+        )
+        part = ".".join(
+            str(event_id) for event_id in [watermark] + seen[:CURSOR_MAX_SEEN]
+        )
+        return part + "+" if len(seen) > CURSOR_MAX_SEEN else part
+    
+    def with_archived_events(
+        self, events, model, data: FilterData, user, period_start, filters
+    ):
+        if data.since:
+            # only old rows are archived, a delta never reaches them
+            return events
+        archived = self.archiver.read_events(
+            model,
+            data.service_tag,
+            user.id,
+            period_start,
+            filters,
+            data.request_parameters,
+        )
+        # a row archived between both reads would otherwise be counted twice
+        seen = {event.id for event in events}
+        return [event for event in archived if event.id not in seen] + events
+    
     def generate_user_statistics(self, data: FilterData):
         logs.info(f"Generating statistics for user: {data.user_hash}")
         
@@ -127,53 +268,77 @@ class Collector:
         # filter events by date, event type, result, etc.
         campaign_events = []
         app_events = []
-        today = datetime.now()
-        if data.period == "day":
-            period_start = today - timedelta(days=1)
-        elif data.period == "week":
-            period_start = today - timedelta(weeks=1)
-        elif data.period == "month":
-            period_start = today - timedelta(weeks=4)
-        elif data.period == "year":
-            period_start = today - timedelta(weeks=52)
-        else:
-            period_start = user.created_at
+        period_start = self.get_period_start(data.period, user.created_at)
+        (
+            (campaign_after, campaign_seen, campaign_truncated),
+            (app_after, app_seen, app_truncated),
+        ) = self.parse_cursor(data.since)
+        cursor_horizon = self.session.execute(
+            select(func.clock_timestamp() - timedelta(seconds=CURSOR_SAFETY_WINDOW))
+        ).scalar()
+        service_tag_keys = select(ServiceTag.id).where(
+            ServiceTag.value == data.service_tag
+        )
         
+        campaign_query = (
+            self.session.query(CampaignEvent)
+            .filter(CampaignEvent.service_tag_key.in_(service_tag_keys))
+            .filter(CampaignEvent.user_id == user.id)
+            .filter(CampaignEvent.created_at >= period_start)
+        )
         if data.campaign_hash:
-            campaign_events = (
-                self.session.query(CampaignEvent)
-                .filter(CampaignEvent.service_tag == data.service_tag)
-                .filter(CampaignEvent.user_id == user.id)
-                .filter(CampaignEvent.campaign_hash == data.campaign_hash)
-                .filter(CampaignEvent.created_at >= period_start)
-                .all()
+            campaign_query = campaign_query.filter(
+                CampaignEvent.campaign_key.in_(
+                    select(Campaign.id).where(
+                        Campaign.campaign_hash == data.campaign_hash
+                    )
+                )
             )
-        else:
-            campaign_events = (
-                self.session.query(CampaignEvent)
-                .filter(CampaignEvent.service_tag == data.service_tag)
-                .filter(CampaignEvent.user_id == user.id)
-                .filter(CampaignEvent.created_at >= period_start)
-                .all()
+        if data.request_parameters:
+            # JSONB containment (@>) is served by the GIN index
+            campaign_query = campaign_query.filter(
+                CampaignEvent.request_parameters.contains(data.request_parameters)
             )
-            
+        campaign_query = campaign_query.filter(CampaignEvent.id > campaign_after)
+        campaign_settled = self.settled_watermark(
+            campaign_query, CampaignEvent, cursor_horizon
+        )
+        # events already returned are not fetched again
+        campaign_events = self.with_archived_events(
+            campaign_query.filter(CampaignEvent.id.notin_(campaign_seen)).all(),
+            CampaignEvent,
+            data,
+            user,
+            period_start,
+            {"campaign_hash": data.campaign_hash} if data.campaign_hash else None,
+        )
+        
+        app_query = (
+            self.session.query(AppEvent)
+            .filter(AppEvent.service_tag_key.in_(service_tag_keys))
+            .filter(AppEvent.user_id == user.id)
+            .filter(AppEvent.created_at >= period_start)
+        )
         if data.app_hash:
-            app_events = (
-                self.session.query(AppEvent)
-                .filter(AppEvent.service_tag == data.service_tag)
-                .filter(AppEvent.user_id == user.id)
-                .filter(AppEvent.app_hash == data.app_hash)
-                .filter(AppEvent.created_at >= period_start)
-                .all()
+            app_query = app_query.filter(
+                AppEvent.app_key.in_(
+                    select(App.id).where(App.app_hash == data.app_hash)
+                )
             )
-        else:
-            app_events = (
-                self.session.query(AppEvent)
-                .filter(CampaignEvent.service_tag == data.service_tag)
-                .filter(AppEvent.user_id == user.id)
-                .filter(AppEvent.created_at >= period_start)
-                .all()
+        if data.request_parameters:
+            app_query = app_query.filter(
+                AppEvent.request_parameters.contains(data.request_parameters)
             )
+        app_query = app_query.filter(AppEvent.id > app_after)
+        app_settled = self.settled_watermark(app_query, AppEvent, cursor_horizon)
+        app_events = self.with_archived_events(
+            app_query.filter(AppEvent.id.notin_(app_seen)).all(),
+            AppEvent,
+            data,
+            user,
+            period_start,
+            {"app_hash": data.app_hash} if data.app_hash else None,
+        )
         
         campaign_emergency = [
             event.model_dump()
@@ -233,6 +398,23 @@ class Collector:
         ]
         
         return {
+            "cursor": ":".join(
+                (
+                    self.make_cursor_part(
+                        campaign_events,
+                        campaign_after,
+                        campaign_seen,
+                        campaign_settled,
+                        cursor_horizon,
+                    ),
+                    self.make_cursor_part(
+                        app_events, app_after, app_seen, app_settled, cursor_horizon
+                    ),
+                )
+            ),
+            # the cursor given was cut short, so events of the previous delta
+            # may come again; clients drop the ids they already have
+            "may_repeat": campaign_truncated or app_truncated,
             "campaign_events": {
                 "total": len(campaign_events),
                 "emergency": {"total": len(campaign_emergency), "events": campaign_emergency},
@@ -252,6 +434,253 @@ class Collector:
             }
         }
         
+    def generate_batch_user_statistics(self, data: list):
+        """
+        Event counts for many users at once, keyed by user_hash. Unlike
+        generate_user_statistics the event lists are left out, which keeps
+        the number of queries constant regardless of the number of users.
+        """
+        logs.info(f"Generating batch statistics for {len(data)} users")
+        if len(data) > BATCH_STATISTICS_MAX_USERS:
+            raise ValueError(
+                f"At most {BATCH_STATISTICS_MAX_USERS} users per batch, got {len(data)}"
+            )
+        if any(item.since for item in data):
+            raise ValueError("since cursors are not supported for batch statistics")
+        
+        # the last filter wins when a user is requested more than once
+        filters = {item.user_hash: item for item in data}
+        users = {
+            user.unique_hash: user
+            for user in self.session.query(PanelUser).filter(
+                PanelUser.unique_hash.in_(filters)
+            )
+        }
+        
+        counts = {}
+        for model, dimension, dimension_key, hash_field in (
+            (CampaignEvent, Campaign, CampaignEvent.campaign_key, "campaign_hash"),
+            (AppEvent, App, AppEvent.app_key, "app_hash"),
+        ):
+            counts[model] = self.count_events_by_user(
+                model, dimension, dimension_key, hash_field, filters, users
+            )
+        
+        statistics = {}
+        for user_hash in filters:
+            user = users.get(user_hash)
+            if not user:
+                logs.error(f"User not found: {user_hash}")
+                statistics[user_hash] = None
+                continue
+            statistics[user_hash] = {
+                "campaign_events": self.summarize_counts(
+                    counts[CampaignEvent], user.id, CAMPAIGN_RESULTS
+                ),
+                "app_events": self.summarize_counts(
+                    counts[AppEvent], user.id, APP_RESULTS
+                ),
+            }
+        return statistics
+    
+    def count_events_by_user(
+        self, model, dimension, dimension_key, hash_field, filters, users
+    ):
+        """
+        One grouped query over the hot table plus one pass over the archive,
+        returning {(user_id, event_result): count}.
+        """
+        conditions = []
+        archive_filters = {}
+        for user_hash, item in filters.items():
+            user = users.get(user_hash)
+            if not user:
+                continue
+            period_start = self.get_period_start(item.period, user.created_at)
+            event_hash = getattr(item, hash_field)
+            
+            condition = [
+                model.user_id == user.id,
+                ServiceTag.value == item.service_tag,
+                model.created_at >= period_start,
+            ]
+            if event_hash:
+                condition.append(getattr(dimension, hash_field) == event_hash)
+            if item.request_parameters:
+                condition.append(
+                    model.request_parameters.contains(item.request_parameters)
+                )
+            conditions.append(and_(*condition))
+            archive_filters[user.id] = (
+                item.service_tag,
+                period_start,
+                {hash_field: event_hash} if event_hash else None,
+                item.request_parameters,
+            )
+        
+        if not conditions:
+            return {}
+        
+        query = (
+            select(
+                model.user_id, model.event_result, func.count(), func.min(model.id)
+            )
+            .join(ServiceTag, ServiceTag.id == model.service_tag_key)
+            .outerjoin(dimension, dimension.id == dimension_key)
+            .where(or_(*conditions))
+            .group_by(model.user_id, model.event_result)
+        )
+        counts = {}
+        first_hot_ids = {}
+        for user_id, event_result, total, first_id in self.session.execute(query):
+            counts[(user_id, event_result)] = total
+            first_hot_ids[user_id] = min(first_hot_ids.get(user_id, first_id), first_id)
+        
+        # a row archived between both reads is already in the hot counts
+        archived = self.archiver.count_events(model, archive_filters, first_hot_ids)
+        for key, total in archived.items():
+            counts[key] = counts.get(key, 0) + total
+        return counts
+    
+    def summarize_counts(self, counts: dict, user_id: int, results: dict):
+        summary = {
+            "total": sum(
+                total
+                for (count_user_id, _), total in counts.items()
+                if count_user_id == user_id
+            )
+        }
+        for event_result, key in results.items():
+            summary[key] = {"total": counts.get((user_id, event_result), 0)}
+        return summary
+    
     def show_campaign_events(self):
         campaign_events = self.session.query(CampaignEvent).all()
-        return campaign_events
\ No newline at end of file
+        return campaign_events
+    
+    def refresh_breakdown_views(self):
+        for name in BREAKDOWN_VIEWS:
+            logs.info(f"Refreshing materialized view: {name}")
+            self.session.execute(
+                text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}")
+            )
+            refresh = self.session.get(ViewRefresh, name)
+            if not refresh:
+                refresh = ViewRefresh(name=name)
+                self.session.add(refresh)
+            refresh.refreshed_at = func.now()
+            self.session.commit()
+    
+    def active_panels(self, service_tags: list, panel_ids: list) -> list:
+        return (
+            self.session.query(Panel)
+            .filter(Panel.is_active.is_(True))
+            .filter(Panel.service_tag.in_(service_tags) | Panel.id.in_(panel_ids))
+            .all()
+        )
+    
+    def record_push(self, panel_id: int, users: int):
+        # several workers push at the same time, so add up in the database
+        statement = insert(PanelPush).values(
+            panel_id=panel_id,
+            users_pushed=users,
+            batches_pushed=1,
+            last_pushed_at=func.now(),
+        )
+        self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[PanelPush.panel_id],
+                set_={
+                    "users_pushed": PanelPush.users_pushed + users,
+                    "batches_pushed": PanelPush.batches_pushed + 1,
+                    "last_pushed_at": statement.excluded.last_pushed_at,
+                },
+            )
+        )
+        self.session.commit()
+    
+    def generate_breakdown(self, data: BreakdownFilterData):
+        """
+        Aggregate events by the requested dimensions. Reads only the
+        materialized breakdown views, never the live event tables, so the
+        result is as fresh as the last view refresh (see "refreshed_at").
+        The views are per day, so the period starts at the beginning of the
+        day it falls on; the effective first day is returned as "from".
+        Archived events are not part of the views, so periods are cut to
+        the first full day of the hot window ("truncated" tells when).
+        """
+        logs.info(f"Generating breakdown for user: {data.user_hash}")
+        
+        if data.source not in BREAKDOWN_DIMENSIONS:
+            raise ValueError(f"Unknown breakdown source: {data.source}")
+        allowed = BREAKDOWN_DIMENSIONS[data.source]
+        invalid = [dim for dim in data.dimensions if dim not in allowed]
+        if invalid or not data.dimensions:
+            raise ValueError(
+                f"Invalid breakdown dimensions: {invalid or data.dimensions}. "
+                f"Allowed for {data.source}: {list(allowed)}"
+            )
+        
+        user = (
+            self.session.query(PanelUser).filter_by(unique_hash=data.user_hash).first()
+        )
+        if not user:
+            logs.error(f"User not found: {data.user_hash}")
+            return None
+        
+        first_day = self.get_period_start(data.period, user.created_at).date()
+        hot_first_day = (self.archiver.hot_window_start() + timedelta(days=1)).date()
+        truncated = first_day < hot_first_day
+        if truncated:
+            first_day = hot_first_day
+        
+        if data.source == "campaign":
+            view = campaign_event_breakdown
+            aggregates = [cast(func.sum(view.c.total), BigInteger).label("total")]
+        else:
+            view = app_event_breakdown
+            aggregates = [
+                cast(func.sum(view.c.total), BigInteger).label("total"),
+                func.sum(view.c.deposit_amount).label("deposit_amount"),
+            ]
+        dimensions = [view.c[dim] for dim in data.dimensions]
+        
+        query = (
+            select(*dimensions, *aggregates)
+            .where(view.c.user_id == user.id)
+            .where(view.c.service_tag == data.service_tag)
+            .where(view.c.day >= first_day)
+            .group_by(*dimensions)
+            .order_by(func.sum(view.c.total).desc())
+        )
+        if data.source == "campaign" and data.campaign_hash:
+            query = query.where(view.c.campaign_hash == data.campaign_hash)
+        if data.source == "app" and data.app_hash:
+            query = query.where(view.c.app_hash == data.app_hash)
+        if data.event_result:
+            query = query.where(view.c.event_result == data.event_result)
+        
+        rows = [dict(row._mapping) for row in self.session.execute(query)]
+        
+        refresh = self.session.get(ViewRefresh, view.name)
+        return {
+            "source": data.source,
+            "dimensions": data.dimensions,
+            "from": first_day.isoformat(),
+            "truncated": truncated,
+            "refreshed_at": (
+                refresh.model_dump()["refreshed_at"] if refresh else None
+            ),
+            "total": sum(row["total"] for row in rows),
+            "rows": rows,
+        }
+    
+    def storage_statistics(self):
+        """
+        Size of the event tables, their indexes and the average bytes per
+        row, to measure the effect of schema changes on storage.
+        """
+        return {
+            table: table_storage(self.session.connection(), table)
+            for table in (CampaignEvent.__tablename__, AppEvent.__tablename__)
+        }
@@ -0,0 +1,64 @@
+from sqlalchemy import and_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import engine
+from utils import logger
+
+
+logs = logger.get_logger(__name__)
+
+# (table name, values) -> surrogate key, shared by all sessions of the process.
+# Dimension rows are never deleted, so cached keys never go stale.
+_keys = {}
+
+
+def get_key(model, **values):
+    """
+    Return the surrogate key of a dimension row, creating the row if needed.
+    Rows are created in their own transaction so a rolled back ingest can
+    not leave a cached key that points to nothing.
+    """
+    if all(value is None for value in values.values()):
+        return None
+
+    cache_key = (
+        model.__tablename__,
+        tuple(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in sorted(values.items())
+        ),
+    )
+    key = _keys.get(cache_key)
+    if key is None:
+        key = _resolve(model, values)
+        _keys[cache_key] = key
+    return key
+
+
+def _resolve(model, values: dict) -> int:
+    lookup = select(model.id).where(
+        and_(
+            *(
+                getattr(model, name).is_(None)
+                if value is None
+                else getattr(model, name) == value
+                for name, value in values.items()
+            )
+        )
+    ).limit(1)
+
+    with engine.begin() as connection:
+        key = connection.execute(lookup).scalar()
+        if key is None:
+            key = connection.execute(
+                insert(model)
+                .values(**values)
+                .on_conflict_do_nothing()
+                .returning(model.id)
+            ).scalar()
+        if key is None:
+            # inserted concurrently by another process
+            key = connection.execute(lookup).scalar()
+
+    logs.info(f"Resolved {model.__tablename__} key {key} for {values}")
+    return key
@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import logger
+
+
+logs = logger.get_logger(__name__)
+
+DELIVERED = "delivered"
+RETRY = "retry"
+REJECTED = "rejected"
+
+
+class PushClient:
+    """
+    Delivers JSON payloads over pooled keep-alive connections from a
+    bounded worker pool. Connection errors, 429 and 5xx responses are
+    retried with exponential backoff of at most max_backoff seconds; a
+    panel asking to wait longer is left to the next push. Other 4xx
+    responses are final.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        pool_hosts: int,
+        timeout: float,
+        max_retries: int,
+        backoff: float,
+        max_backoff: float,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # pool_connections is the number of hosts whose connections are
+        # kept, pool_maxsize the connections kept per host
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=workers)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="statistics-push"
+        )
+
+    @staticmethod
+    def batches(items: list, batch_size: int) -> list:
+        return [
+            items[start:start + batch_size]
+            for start in range(0, len(items), batch_size)
+        ]
+
+    def deliver_all(self, deliveries: list) -> list:
+        """
+        Deliver (url, payload) pairs concurrently; return their outcomes in
+        the same order.
+        """
+        futures = [
+            self.executor.submit(self.deliver, url, payload)
+            for url, payload in deliveries
+        ]
+        return [future.result() for future in futures]
+
+    def deliver(self, url: str, payload: dict) -> str:
+        for attempt in range(self.max_retries + 1):
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+            try:
+                response = self.http.post(url, json=payload, timeout=self.timeout)
+                if response.ok:
+                    return DELIVERED
+                if response.status_code < 500 and response.status_code != 429:
+                    logs.error(f"Panel {url} rejected statistics: {response.status_code}")
+                    return REJECTED
+                retry_after = response.headers.get("Retry-After", "")
+                logs.warning(
+                    f"Panel {url} returned {response.status_code}, "
+                    f"attempt {attempt + 1}"
+                )
+                if retry_after.isdigit():
+                    if int(retry_after) > self.max_backoff:
+                        logs.warning(f"Panel {url} asked to retry after {retry_after}s")
+                        return RETRY
+                    delay = max(delay, int(retry_after))
+            except requests.RequestException as e:
+                logs.warning(
+                    f"Error pushing statistics to {url}, attempt {attempt + 1}: \n{e}"
+                )
+            if attempt < self.max_retries:
+                time.sleep(delay)
+
+        logs.error(f"Giving up pushing statistics to {url}")
+        return RETRY
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.http.close()
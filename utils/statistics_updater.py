@@ -1,7 +1,138 @@
-import requests
+import threading
 
-from config import SQLALCHEMY_DATABASE_URI
-from models import Panel, Statistics
+from config import (
+    SQLALCHEMY_DATABASE_URI,
+    PUSH_URL_TEMPLATE,
+    PUSH_PERIOD,
+    PUSH_BATCH_SIZE,
+    PUSH_WORKERS,
+    PUSH_POOL_HOSTS,
+    PUSH_TIMEOUT,
+    PUSH_MAX_RETRIES,
+    PUSH_BACKOFF,
+    PUSH_MAX_BACKOFF,
+)
+from dataclass import FilterData
 from utils import logger
+from utils.push_client import PushClient, DELIVERED, RETRY
 
 
+logs = logger.get_logger(__name__)
+
+
+class StatisticsUpdater:
+    """
+    Pushes user statistics to the active panels of a service_tag instead of
+    having panels poll for them. Ingest marks users as changed; every push
+    sends each changed user once, however many events arrived, in batches
+    over pooled keep-alive connections.
+
+    collector_class is called with the session of each push and provides
+    the database side: active_panels, generate_batch_user_statistics and
+    record_push.
+    """
+
+    def __init__(
+        self,
+        collector_class,
+        url_template: str = PUSH_URL_TEMPLATE,
+        period: str = PUSH_PERIOD,
+        batch_size: int = PUSH_BATCH_SIZE,
+        workers: int = PUSH_WORKERS,
+        pool_hosts: int = PUSH_POOL_HOSTS,
+        timeout: float = PUSH_TIMEOUT,
+        max_retries: int = PUSH_MAX_RETRIES,
+        backoff: float = PUSH_BACKOFF,
+        max_backoff: float = PUSH_MAX_BACKOFF,
+    ):
+        self.collector_class = collector_class
+        self.url_template = url_template
+        self.period = period
+        self.batch_size = batch_size
+        self.client = PushClient(
+            workers, pool_hosts, timeout, max_retries, backoff, max_backoff
+        )
+
+        # service_tag -> user hashes changed since the last push
+        self.changed = {}
+        # panel id -> user hashes whose delivery to that panel must be retried
+        self.retries = {}
+        self.lock = threading.Lock()
+
+    def mark_changed(self, service_tag: str, user_hash: str):
+        with self.lock:
+            self.changed.setdefault(service_tag, set()).add(user_hash)
+
+    def requeue(self, changed: dict, retries: dict):
+        with self.lock:
+            for service_tag, user_hashes in changed.items():
+                self.changed.setdefault(service_tag, set()).update(user_hashes)
+            for panel_id, user_hashes in retries.items():
+                self.retries.setdefault(panel_id, set()).update(user_hashes)
+
+    def push(self, session):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            retries, self.retries = self.retries, {}
+        if not changed and not retries:
+            return
+
+        try:
+            self.push_pending(session, changed, retries)
+        except Exception:
+            # nothing is lost, the next push sends it again
+            self.requeue(changed, retries)
+            raise
+
+    def push_pending(self, session, changed: dict, retries: dict):
+        collector = self.collector_class(session)
+        panels = collector.active_panels(list(changed), list(retries))
+        logs.info(f"Pushing statistics to {len(panels)} panels")
+
+        # statistics are built here, the session is not shared with workers;
+        # panels of one service_tag mostly get the same batches
+        statistics = {}
+        deliveries = []
+        for panel in panels:
+            user_hashes = sorted(
+                changed.get(panel.service_tag, set()) | retries.get(panel.id, set())
+            )
+            url = self.url_template.format(domain=panel.domain)
+            for batch in self.client.batches(user_hashes, self.batch_size):
+                key = (panel.service_tag, tuple(batch))
+                if key not in statistics:
+                    statistics[key] = collector.generate_batch_user_statistics(
+                        [
+                            FilterData(
+                                user_hash=user_hash,
+                                service_tag=panel.service_tag,
+                                period=self.period,
+                            )
+                            for user_hash in batch
+                        ]
+                    )
+                payload = {
+                    "service_tag": panel.service_tag,
+                    "period": self.period,
+                    "statistics": statistics[key],
+                }
+                deliveries.append((panel.id, batch, url, payload))
+
+        outcomes = self.client.deliver_all(
+            [(url, payload) for _, _, url, payload in deliveries]
+        )
+        for (panel_id, batch, url, _), outcome in zip(deliveries, outcomes):
+            if outcome == RETRY:
+                self.requeue({}, {panel_id: set(batch)})
+            elif outcome == DELIVERED:
+                self.record_delivery(collector, panel_id, len(batch))
+
+    def record_delivery(self, collector, panel_id: int, users: int):
+        try:
+            collector.record_push(panel_id, users)
+        except Exception as e:
+            collector.session.rollback()
+            logs.error(f"Error recording statistics push to panel {panel_id}: \n{e}")
+
+    def close(self):
+        self.client.close()